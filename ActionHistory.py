@@ -14,6 +14,8 @@
 # You should have received a copy of the GNU General Public License along
 # with this program.  If not, see <http://www.gnu.org/licenses/>. 
 
+import collections
+
 class MoveAndUpdateAction:
     def __init__(self, document_id, old_path, path):
         self.document_id = document_id
@@ -41,33 +43,24 @@ class NoneAction:
 
 class ActionHistory:
     def remove_action(self, doc_id):
-        del self.actions[doc_id]
+        self._counts[type(self.actions.pop(doc_id))] -= 1
 
     def get_action(self, doc_id):
         return self.actions[doc_id]
 
     def add_action(self, action):
+        previous_action = self.actions.get(action.document_id)
+        if previous_action is not None:
+            self._counts[type(previous_action)] -= 1
         self.actions[action.document_id] = action
+        self._counts[type(action)] += 1
 
     def format_summary(self):
-        additions = 0
-        removals = 0
-        updates = 0
-        move_and_updates = 0
-        for action in self.actions.values():
-            if isinstance(action, AddAction):
-                additions += 1
-            elif isinstance(action, RemoveAction):
-                removals += 1
-            elif isinstance(action, UpdateAction):
-                updates += 1
-            elif isinstance(action, MoveAndUpdateAction):
-                move_and_updates += 1
-        
-        return (f'{additions} new documents were added\n'
-                f'{removals} documents were removed\n'
-                f'{updates} documents were updated\n'
-                f'{move_and_updates} documents were moved and possibly updated')
+        return (f'{self._counts[AddAction]} new documents were added\n'
+                f'{self._counts[RemoveAction]} documents were removed\n'
+                f'{self._counts[UpdateAction]} documents were updated\n'
+                f'{self._counts[MoveAndUpdateAction]} documents were moved and possibly updated')
 
     def __init__(self):
-        self.actions = {}
\ No newline at end of file
+        self.actions = {}
+        self._counts = collections.Counter()
\ No newline at end of file
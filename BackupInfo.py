@@ -14,9 +14,10 @@
 # You should have received a copy of the GNU General Public License along
 # with this program.  If not, see <http://www.gnu.org/licenses/>. 
 
-import bidict
-from datetime import datetime
+from BiDict import BiDict
+from datetime import datetime, timezone
 from Formatting import PercentTemplate
+from JsonFile import save_json
 import json
 import pathlib
 
@@ -26,12 +27,13 @@ class BackupInfoEncoder(json.JSONEncoder):
             return {'last_backup_time': obj.last_backup_time,
                     'documents': obj.documents,
                     'pattern': obj.pattern}
-        elif isinstance(obj, bidict.bidict):
+        elif isinstance(obj, BiDict):
             return dict(obj)
         elif isinstance(obj, PercentTemplate):
             return obj.template
         elif isinstance(obj, datetime):
-            return obj.isoformat()
+            #Times are stored as naive UTC times
+            return obj.astimezone(timezone.utc).replace(tzinfo=None).isoformat()
         
         return json.JSONEncoder.default(self, obj)
 
@@ -40,28 +42,49 @@ class BackupInfoEncoder(json.JSONEncoder):
 encoder = BackupInfoEncoder(indent = '  ')
 
 class BackupInfo:
+    def _build_document_dirs(self):
+        """Build the set of all document directories and all of their ancestors."""
+        document_dirs = set()
+        for d in self.documents.values():
+            path = pathlib.Path(d)
+            document_dirs.add(path)
+            document_dirs.update(path.parents)
+        return document_dirs
+
     def contains_documents(self, dir):
         """Whether any documents are in the given directory"""
-        return any(pathlib.Path(d).is_relative_to(dir) for d in self.documents.values())
+        if self._document_dirs is None:
+            self._document_dirs = self._build_document_dirs()
+        return pathlib.Path(dir) in self._document_dirs
+
+    def set_document_path(self, id, path):
+        """Set the path of the document with the given id."""
+        self.documents[id] = path
+        self._document_dirs = None
+
+    def remove_document(self, id):
+        """Remove the document with the given id and return its path."""
+        self._document_dirs = None
+        return self.documents.pop(id)
 
     def used_by_other_document(self, id, path):
-        return path in self.documents.inverse and self.documents.inverse[path] != id
+        other_id = self.documents.inverse.get(path)
+        return other_id is not None and other_id != id
 
     def save(self, filename):
-        with open(filename, 'w') as f:
-            encoded = encoder.encode(self)
-            f.write(encoded)
+        save_json(filename, self, encoder, passthrough_datetime=True)
 
     def load(filename):
-        with open(filename, 'r') as f:
+        with open(filename, 'rb') as f:
             data = json.load(f)
         obj = BackupInfo(data['pattern'])
-        obj.last_backup_time = datetime.fromisoformat(data['last_backup_time'])
-        obj.documents = bidict.bidict(data['documents'])
+        obj.last_backup_time = datetime.fromisoformat(data['last_backup_time']).replace(tzinfo=timezone.utc)
+        obj.documents = BiDict(data['documents'])
 
         return obj
 
     def __init__(self, pattern):
         self.last_backup_time = None
-        self.documents = bidict.bidict()
+        self.documents = BiDict()
+        self._document_dirs = None
         self.pattern = PercentTemplate(pattern)
\ No newline at end of file
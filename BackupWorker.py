@@ -14,10 +14,10 @@
 # You should have received a copy of the GNU General Public License along
 # with this program.  If not, see <http://www.gnu.org/licenses/>. 
 
-import arrow
 import ActionHistory
 from BackupInfo import BackupInfo
-from datetime import datetime
+import concurrent.futures
+from datetime import datetime, timezone
 from DocumentInfo import DocumentInfo
 import Formatting
 import hashlib
@@ -26,19 +26,50 @@ import pathlib
 import requests
 import shutil
 
+CHECKSUM_CHUNK_SIZE = 1024 * 1024
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+DEFAULT_MAX_WORKERS = 8
+LIST_PAGE_SIZE = 500
+
 def calculate_checksum(filename):
     """Calculates a checksum of a given file"""
-    hash = hashlib.sha1()
     with open(filename, "rb") as f:
-        for chunk in iter(lambda: f.read(4096), b""):
+        if hasattr(hashlib, 'file_digest'):
+            return hashlib.file_digest(f, 'sha1').hexdigest()
+
+        #Python < 3.11: read in large chunks to keep the number of calls into hashlib low
+        hash = hashlib.sha1()
+        for chunk in iter(lambda: f.read(CHECKSUM_CHUNK_SIZE), b""):
             hash.update(chunk)
     
     return hash.hexdigest()
 
+def _scandir(dir):
+    """List the entries of a directory as os.DirEntry objects, which cache the file type."""
+    with os.scandir(dir) as entries:
+        return list(entries)
+
+def _is_empty_dir(dir):
+    """Whether a directory is empty, without listing all of its entries."""
+    with os.scandir(dir) as entries:
+        return next(entries, None) is None
+
+class _HashingWriter:
+    """File-like object that calculates the checksum of everything that is written to the underlying file."""
+    def write(self, data):
+        self.hash.update(data)
+        return self.file.write(data)
+
+    def __init__(self, file):
+        self.file = file
+        self.hash = hashlib.sha1()
+
 class BackupWorker:
     def _get_document_path(self, backup_info, document):
-        authors_last_names = Formatting.format_authors([a.last_name for a in document.authors] if document.authors else [])
-        output_path = backup_info.pattern.substitute({'authors': Formatting.replace_invalid_characters(authors_last_names),
+        #document.authors builds new Person objects on every access
+        authors = document.authors
+        authors_last_names = Formatting.format_authors([a.last_name for a in authors] if authors else [])
+        output_path = backup_info.pattern.format({'authors': Formatting.replace_invalid_characters(authors_last_names),
                                                     'year': document.year,
                                                     'title': Formatting.replace_invalid_characters(document.title)})
         #TODO: add other fields to the pattern
@@ -47,30 +78,65 @@ class BackupWorker:
     def _get_document_info_path(self, document_path):
         return document_path.joinpath('info.json')
 
-    def _download_file(self, file, file_path):
+    def _store_file_stats(self, document_info, file_id, stat, checksum):
+        """Remember the size, modification time and checksum of a local file in the document info."""
+        document_info.file_stats[file_id] = {'size': stat.st_size,
+                                             'mtime_ns': stat.st_mtime_ns,
+                                             'sha1': checksum}
+
+    def _download_file(self, file, file_path, temp_dir, document_info):
+        """Download a file and verify its checksum while downloading.
+        
+        The file is first downloaded into the temporary directory temp_dir of the document, where it can not clash with 
+        the other files of the document, and only moved to file_path once it is complete."""
+        self._make_dirs(temp_dir)
+        part_path = temp_dir.joinpath(f'{file.id}.part')
         try:
             with requests.get(file.download_url, stream=True) as response:
-                with open(file_path, 'wb') as downloaded_file:
-                    for chunk in response.iter_content(chunk_size=8192):
-                        downloaded_file.write(chunk)
-            return True
+                response.raise_for_status()
+                response.raw.decode_content = True
+                with open(part_path, 'wb') as downloaded_file:
+                    writer = _HashingWriter(downloaded_file)
+                    shutil.copyfileobj(response.raw, writer, length=DOWNLOAD_CHUNK_SIZE)
         except Exception as e:
             print(f'WARNING: failed to download file {file.file_name} at {file_path}: {e}')
-            file_path.unlink()
+            part_path.unlink(missing_ok=True)
             return False
 
-    def _file_needs_update(self, file, file_path):
-        return file.filehash != calculate_checksum(file_path)
+        checksum = writer.hash.hexdigest()
+        if checksum != file.filehash:
+            print(f'WARNING: checksum of downloaded file {file.file_name} at {file_path} does not match the checksum '
+                  'reported by Mendeley. Discarding the file...')
+            part_path.unlink()
+            return False
+
+        os.replace(part_path, file_path)
+        self._store_file_stats(document_info, file.id, file_path.stat(), checksum)
+        return True
+
+    def _file_needs_update(self, file, file_path, document_info):
+        """Whether the local file differs from the remote one.
+        
+        The checksum of the local file is only recalculated if its size or modification time changed since the last 
+        time it was calculated."""
+        stat = file_path.stat()
+        cached = document_info.file_stats.get(file.id)
+        if cached is not None and cached['size'] == stat.st_size and cached['mtime_ns'] == stat.st_mtime_ns:
+            checksum = cached['sha1']
+        else:
+            checksum = calculate_checksum(file_path)
+            self._store_file_stats(document_info, file.id, stat, checksum)
+        return file.filehash != checksum
             
 
     def _handle_document(self, document, document_path):
         document_path_full = self.backup_location.joinpath(document_path)
-        document_path_full.mkdir(parents = True, exist_ok = True)
+        self._make_dirs(document_path_full)
         document_info_path = self._get_document_info_path(document_path_full)
         if document_info_path.exists():
             try:
-                document_files = DocumentInfo.load_files(document_info_path)
-                document_info = DocumentInfo(document, document_files)
+                document_files, document_file_stats = DocumentInfo.load_files_and_stats(document_info_path)
+                document_info = DocumentInfo(document, document_files, document_file_stats)
             except:
                 print(f'WARNING: could not parse {document_info_path.name} in {document_path_full}. '
                       'Handling as new document...')
@@ -80,45 +146,54 @@ class BackupWorker:
 
         file_ids_remote = set()
         temporary_stored_files = {}
+        temp_dir = document_path_full.joinpath('.temp')
         for file in document.files.iter():
             file_ids_remote.add(file.id)
             file_path_full = document_path_full.joinpath(file.file_name)
-            if file_path_full.is_relative_to('.temp'):
+            if pathlib.Path(file.file_name).is_relative_to('.temp'):
                 print(f'ERROR: file {file.file_name} of document at {document_path_full} would be stored relative to '
                       'the temporary directory .temp. This is not allowed. The file will be ignored')
                 continue
-            if document_info.used_by_other_file(file.id, file.file_name):
+            #The name of a temporarily stored file is only updated once all other files have been handled
+            stored_temporarily = document_info.used_by_other_file(file.id, file.file_name)
+            if stored_temporarily:
                 temporary_stored_files[file.id] = file.file_name
-                file_path_full = document_path_full.joinpath(f'.temp/{file.id}')
+                file_path_full = temp_dir.joinpath(file.id)
+                self._make_dirs(temp_dir)
 
             if file.id in document_info.files:
                 previous_file_name = document_info.files[file.id]
                 if file.file_name != previous_file_name:
                     previous_file_path_full = document_path_full.joinpath(previous_file_name)
-                    if previous_file_path_full.exists():
-                        os.rename(previous_file_path_full, file_path_full)
-                        document_info.files[file.id] = file.file_name
-                        if self._file_needs_update(file, file_path_full):
-                            self._download_file(file, file_path_full)
-                    else:
+                    try:
+                        os.replace(previous_file_path_full, file_path_full)
+                    except FileNotFoundError:
                         print(f'WARNING: file {file.file_name} of document at {document_path_full} used to be at '
                             f'{previous_file_name}, but does not exist anymore. Redownloading the file...')
-                        self._download_file(file, file_path_full)
-                else:
-                    if file_path_full.exists():
-                        if self._file_needs_update(file, file_path_full):
-                            self._download_file(file, file_path_full)
+                        self._download_file(file, file_path_full, temp_dir, document_info)
                     else:
+                        if self._file_needs_update(file, file_path_full, document_info):
+                            self._download_file(file, file_path_full, temp_dir, document_info)
+                    if not stored_temporarily:
+                        document_info.files[file.id] = file.file_name
+                else:
+                    try:
+                        needs_update = self._file_needs_update(file, file_path_full, document_info)
+                    except FileNotFoundError:
                         print(f'WARNING: file {file.file_name} of document at {document_path_full} does not exist anymore. '
                                'Redownloading the file...')
-                        self._download_file(file, file_path_full)
+                        needs_update = True
+                    if needs_update:
+                        self._download_file(file, file_path_full, temp_dir, document_info)
             else:
-                self._download_file(file, file_path_full)
-                document_info.files[file.id] = file.file_name
+                self._download_file(file, file_path_full, temp_dir, document_info)
+                if not stored_temporarily:
+                    document_info.files[file.id] = file.file_name
         
-        removed_file_ids = set(document_info.files.keys()) - file_ids_remote
+        removed_file_ids = document_info.files.keys() - file_ids_remote
         for file_id in removed_file_ids:
             file_name = document_info.files.pop(file_id)
+            document_info.file_stats.pop(file_id, None)
             file_path_full = document_path_full.joinpath(file_name)
             if file_path_full.exists():
                 file_path_full.unlink()
@@ -126,29 +201,46 @@ class BackupWorker:
                 print(f'WARNING: file {file_name} of document at {document_path_full} used to exist, but does not exist anymore. '
                        'Skipping removal...')
         
+        #The temporarily stored files no longer exist under their previous names
+        for file_id in temporary_stored_files:
+            document_info.files.pop(file_id, None)
         for file_id, file_name in temporary_stored_files.items():
-            if document_info.used_by_other_file(file.id, file_name):
-                print(f'WARNING: file {file.file_name} of document at {document_path_full} is already used by a file '
+            if document_info.used_by_other_file(file_id, file_name):
+                print(f'WARNING: file {file_name} of document at {document_path_full} is already used by a file '
                        'with another id. Does the document contain duplicate files? Skipping...')
-                del document_info.files[file_id]
+                document_info.file_stats.pop(file_id, None)
                 continue
 
             file_path_full = document_path_full.joinpath(file_name)
-            os.rename(f'.temp/{file_id}', file_path_full)
+            try:
+                os.replace(temp_dir.joinpath(file_id), file_path_full)
+            except FileNotFoundError:
+                #The download failed, the file will be downloaded again during the next backup
+                document_info.file_stats.pop(file_id, None)
+                continue
             document_info.files[file_id] = file_name
 
-        temp_dir = document_path_full.joinpath('.temp')
-        if temp_dir.exists():
+        if temp_dir in self._created_dirs:
             shutil.rmtree(temp_dir)
+            self._created_dirs.discard(temp_dir)
         
         #TODO: maybe I should add support for two files with the same name (but different ids) in the same document (then probably use a checksum to check that it isn't a duplicate)
         document_info.save(self._get_document_info_path(document_path_full))
 
+    def _make_dirs(self, dir):
+        """Create dir and all of its parents, unless it was already created during this backup."""
+        if dir in self._created_dirs:
+            return
+        dir.mkdir(parents=True, exist_ok=True)
+        self._created_dirs.add(dir)
+        self._created_dirs.update(dir.parents)
+
     def _remove_recursive_if_empty(self, dir):
         """Remove dir and all of its parents up to self.backup_location if they are empty."""
         assert(dir.is_relative_to(self.backup_location))
-        while dir != self.backup_location and not any(dir.iterdir()):
+        while dir != self.backup_location and _is_empty_dir(dir):
                 dir.rmdir()
+                self._created_dirs.discard(dir)
                 dir = dir.parent
 
     def _move_document_dir(self, previous_dir, new_dir, remove_previous_dir_parent_if_empty=True):
@@ -157,11 +249,12 @@ class BackupWorker:
         if not previous_full_dir.exists():
             print(f'WARNING: document {new_dir} used to be at {previous_dir}, but that directory does not exist anymore. '
                    'Handling as new document...')
-            new_full_dir.mkdir(parents=True, exist_ok=True)
+            self._make_dirs(new_full_dir)
             return
 
-        new_full_dir.parent.mkdir(parents=True, exist_ok=True)
-        os.rename(previous_full_dir, new_full_dir)
+        self._make_dirs(new_full_dir.parent)
+        os.replace(previous_full_dir, new_full_dir)
+        self._created_dirs.discard(previous_full_dir)
         if remove_previous_dir_parent_if_empty:
             self._remove_recursive_if_empty(previous_full_dir.parent)
 
@@ -173,6 +266,7 @@ class BackupWorker:
             return
 
         shutil.rmtree(full_dir)
+        self._created_dirs.discard(full_dir)
         self._remove_recursive_if_empty(full_dir.parent)
 
     def _remove_unaccounted_files_in_document_dir(self, dir):
@@ -183,25 +277,26 @@ class BackupWorker:
             return
         
         document_files = DocumentInfo.load_files(document_info_path)
-        for file in dir.iterdir():
-            if file.name == 'info.json':
+        for entry in _scandir(dir):
+            if entry.name == 'info.json':
                 continue
-            if file.name not in document_files.inverse:
-                print(f'WARNING: file {file} does not correspond to any mendeley file. Removing...')
-                if file.is_dir():
-                    shutil.rmtree(file)
+            if entry.name not in document_files.inverse:
+                print(f'WARNING: file {entry.path} does not correspond to any mendeley file. Removing...')
+                if entry.is_dir(follow_symlinks=False):
+                    shutil.rmtree(entry.path)
                 else:
-                    file.unlink()
+                    os.unlink(entry.path)
     
     def _remove_unaccounted_files_in_non_document_dir(self, backup_info, dir, ignore_info_file):
-        for file in dir.iterdir():
-            if ignore_info_file and file.name == 'info.json':
+        for entry in _scandir(dir):
+            if ignore_info_file and entry.name == 'info.json':
                 continue
-            elif not file.is_dir():
-                print(f'WARNING: file {file} is not in any document directory. Removing...')
-                file.unlink()
+            elif not entry.is_dir(follow_symlinks=False):
+                print(f'WARNING: file {entry.path} is not in any document directory. Removing...')
+                os.unlink(entry.path)
                 continue
 
+            file = pathlib.Path(entry.path)
             file_relative = file.relative_to(self.backup_location)
             if str(file_relative) in backup_info.documents.inverse:
                 self._remove_unaccounted_files_in_document_dir(file)
@@ -217,7 +312,8 @@ class BackupWorker:
         self._remove_unaccounted_files_in_non_document_dir(backup_info, self.backup_location, True)
     
     def execute(self):
-        self.backup_location.mkdir(parents=True, exist_ok=True)
+        self._created_dirs = set()
+        self._make_dirs(self.backup_location)
 
         backup_info_path = self.backup_location.joinpath('info.json')
         if backup_info_path.exists():
@@ -231,80 +327,88 @@ class BackupWorker:
         
         self._remove_unaccounted_files(backup_info)
 
-        new_backup_time = datetime.utcnow()
+        new_backup_time = datetime.now(timezone.utc)
+        last_backup_time = backup_info.last_backup_time
         history = ActionHistory.ActionHistory()
-        new_document_ids = set()
-        modified_document_ids = set()
-        unmodified_document_ids = set()
-        for doc in self.mendeley_session.documents.iter():
-            if doc.id in backup_info.documents:
-                if doc.last_modified >= arrow.get(backup_info.last_backup_time):
-                    modified_document_ids.add(doc.id)
+        new_documents = {}
+        modified_documents = {}
+        removed_document_ids = set(backup_info.documents.keys())
+        #Listing all documents with the full view avoids fetching every new or modified document separately
+        for doc in self.mendeley_session.documents.iter(page_size=LIST_PAGE_SIZE, view='all'):
+            if doc.id in removed_document_ids:
+                removed_document_ids.remove(doc.id)
+                if doc.last_modified.datetime >= last_backup_time:
+                    modified_documents[doc.id] = doc
                 else:
-                    unmodified_document_ids.add(doc.id)
                     history.add_action(ActionHistory.NoneAction(doc.id))
             else:
-                new_document_ids.add(doc.id)
-        removed_document_ids = set(backup_info.documents.keys()) - (modified_document_ids | unmodified_document_ids)
+                new_documents[doc.id] = doc
 
         for doc_id in removed_document_ids:
-            old_document_path = backup_info.documents.pop(doc_id)
+            old_document_path = backup_info.remove_document(doc_id)
             self._remove_document_dir(old_document_path)
             history.add_action(ActionHistory.RemoveAction(doc_id, old_document_path))
         
-        temporary_stored_documents = {}
-        for doc_id in modified_document_ids:
-            doc = self.mendeley_session.documents.get(doc_id, view='all')
-            old_document_path = backup_info.documents[doc.id]
-            document_path = self._get_document_path(backup_info, doc)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            #Moving documents and updating the backup info is done sequentially, as documents may depend on each 
+            #other's paths. Afterwards, every document has its own directory and can be handled in parallel.
+            temporary_stored_documents = {}
+            documents_to_handle = []
+            for doc in modified_documents.values():
+                old_document_path = backup_info.documents[doc.id]
+                document_path = self._get_document_path(backup_info, doc)
+                
+                if old_document_path != document_path:
+                    if pathlib.Path(document_path).is_relative_to('.temp'):
+                        print(f'ERROR: document {document_path} would be stored relative to the temporary directory .temp. This '
+                               'is not allowed. Specify another pattern. The document will be skipped.')
+                        self._remove_document_dir(old_document_path)
+                        history.add_action(ActionHistory.RemoveAction(doc.id, old_document_path))
+                        backup_info.remove_document(doc.id)
+                        continue
+
+                    if backup_info.used_by_other_document(doc.id, document_path):
+                        temporary_stored_documents[doc.id] = document_path
+                        document_path = f'.temp/{doc.id}'
+                    
+                    self._move_document_dir(old_document_path, document_path)
+                    history.add_action(ActionHistory.MoveAndUpdateAction(doc.id, old_document_path, document_path))
+                else:
+                    history.add_action(ActionHistory.UpdateAction(doc.id, document_path))
+                
+                documents_to_handle.append((doc, document_path))
+                backup_info.set_document_path(doc.id, document_path)
             
-            if old_document_path != document_path:
+            for doc in new_documents.values():
+                document_path = self._get_document_path(backup_info, doc)
                 if pathlib.Path(document_path).is_relative_to('.temp'):
                     print(f'ERROR: document {document_path} would be stored relative to the temporary directory .temp. This '
-                           'is not allowed. Specify another pattern. The document will be skipped.')
-                    self._remove_document_dir(old_document_path)
-                    history.add_action(ActionHistory.RemoveAction(doc_id, old_document_path))
-                    del backup_info.documents[doc_id]
+                            'is not allowed. Specify another pattern. The document will be skipped.')
                     continue
 
                 if backup_info.used_by_other_document(doc.id, document_path):
-                    temporary_stored_documents[doc_id] = document_path
-                    document_path = f'.temp/{doc_id}'
-                
-                self._move_document_dir(old_document_path, document_path)
-                history.add_action(ActionHistory.MoveAndUpdateAction(doc.id, old_document_path, document_path))
-            else:
-                history.add_action(ActionHistory.UpdateAction(doc.id, document_path))
-            
-            self._handle_document(doc, document_path)
-            backup_info.documents[doc.id] = document_path
-        
-        for doc_id in new_document_ids:
-            doc = self.mendeley_session.documents.get(doc_id, view='all')
-            document_path = self._get_document_path(backup_info, doc)
-            if pathlib.Path(document_path).is_relative_to('.temp'):
-                print(f'ERROR: document {document_path} would be stored relative to the temporary directory .temp. This '
-                        'is not allowed. Specify another pattern. The document will be skipped.')
-                continue
+                    temporary_stored_documents[doc.id] = document_path
+                    document_path = f'.temp/{doc.id}'
+                history.add_action(ActionHistory.AddAction(doc.id, document_path))
+                documents_to_handle.append((doc, document_path))
+                backup_info.set_document_path(doc.id, document_path)
 
-            if backup_info.used_by_other_document(doc.id, document_path):
-                temporary_stored_documents[doc_id] = document_path
-                document_path = f'.temp/{doc_id}'
-            history.add_action(ActionHistory.AddAction(doc.id, document_path))
-            self._handle_document(doc, document_path)
-            backup_info.documents[doc.id] = document_path
+            futures = [executor.submit(self._handle_document, doc, document_path) 
+                       for doc, document_path in documents_to_handle]
+            for future in concurrent.futures.as_completed(futures):
+                future.result()
 
         for doc_id, document_path in temporary_stored_documents.items():
-            if backup_info.used_by_other_document(doc.id, document_path):
+            if backup_info.used_by_other_document(doc_id, document_path):
                 print(f'WARNING: document {document_path} is already used by a mendeley document with another id. '
                        'Duplicate document in your library? Skipping...')
                 history.remove_action(doc_id)
-                del backup_info.documents[doc_id]
+                backup_info.remove_document(doc_id)
                 continue
 
             self._move_document_dir(f'.temp/{doc_id}', document_path, remove_previous_dir_parent_if_empty=False)
             history.get_action(doc_id).path = document_path
-            backup_info.documents[doc.id] = document_path
+            backup_info.set_document_path(doc_id, document_path)
         
         temp_dir = self.backup_location.joinpath('.temp')
         if temp_dir.exists():
@@ -322,15 +426,19 @@ class BackupWorker:
         return history
         #TODO: do I need to separately backup the groups? (or maybe allow a command line arguemnt to also include the groups or something)
 
-    def __init__(self, mendeley_session, backup_location, pattern, pattern_option_provided=False):
+    def __init__(self, mendeley_session, backup_location, pattern, pattern_option_provided=False, 
+                 max_workers=DEFAULT_MAX_WORKERS):
         """Initialize a new BackupWorker.
 
         :param mendeley_session: the mendeley session to use for the backup
         :param backup_location: the location to store the backup
         :param pattern: the pattern to use for the backup
         :param pattern_option_provided: whether the pattern was provided as a command line option
+        :param max_workers: the maximum number of documents that are handled in parallel
         """
         self.mendeley_session = mendeley_session
         self.backup_location = backup_location
         self.pattern = pattern
-        self.pattern_option_provided = pattern_option_provided
\ No newline at end of file
+        self.pattern_option_provided = pattern_option_provided
+        self.max_workers = max_workers
+        self._created_dirs = set()
\ No newline at end of file
@@ -0,0 +1,58 @@
+#
+# Copyright (C) 2024 Tobe Deprez
+# 
+# This is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+ 
+# This file is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>. 
+
+from collections.abc import MutableMapping
+import types
+
+class BiDict(MutableMapping):
+    """A dictionary with unique values that also keeps track of the inverse mapping from values to keys."""
+    @property
+    def inverse(self):
+        """A read-only view of the mapping from values to keys."""
+        return self._inverse_view
+
+    def __getitem__(self, key):
+        return self._forward[key]
+
+    def __setitem__(self, key, value):
+        if value in self._inverse and self._inverse[value] != key:
+            raise ValueError(f'Value {value} is already used by key {self._inverse[value]}')
+        if key in self._forward:
+            del self._inverse[self._forward[key]]
+        self._forward[key] = value
+        self._inverse[value] = key
+
+    def __delitem__(self, key):
+        del self._inverse[self._forward.pop(key)]
+
+    def __iter__(self):
+        return iter(self._forward)
+
+    def __len__(self):
+        return len(self._forward)
+
+    def __contains__(self, key):
+        return key in self._forward
+
+    def __repr__(self):
+        return f'BiDict({self._forward!r})'
+
+    def __init__(self, items=None):
+        self._forward = {}
+        self._inverse = {}
+        self._inverse_view = types.MappingProxyType(self._inverse)
+        if items is not None:
+            self.update(items)
@@ -15,7 +15,8 @@
 # with this program.  If not, see <http://www.gnu.org/licenses/>. 
 
 import arrow
-import bidict
+from BiDict import BiDict
+from JsonFile import save_json
 import json
 import mendeley
 import pathlib
@@ -30,7 +31,8 @@ class DocumentEncoder(json.JSONEncoder):
             return {'first_name': obj.first_name, 'last_name': obj.last_name}
         elif isinstance(obj, DocumentInfo):
             return {'document': obj.document,
-                    'files': obj.files}
+                    'files': obj.files,
+                    'file_stats': obj.file_stats}
         elif isinstance(obj, mendeley.models.documents.UserDocument):
             converted = {'authors': obj.authors,
                          'id': obj.id,
@@ -71,7 +73,7 @@ class DocumentEncoder(json.JSONEncoder):
                 converted.update({'tags': obj.tags})
             
             return converted
-        elif isinstance(obj, bidict.bidict):
+        elif isinstance(obj, BiDict):
             return dict(obj)
 
         return json.JSONEncoder.default(self, obj)
@@ -80,19 +82,33 @@ encoder = DocumentEncoder(indent = '  ')
 class DocumentInfo:
     def used_by_other_file(self, id, filename):
         """Whether the given file is used by another file in the same document."""
-        return filename in self.files.inverse and self.files.inverse[filename] != id
+        other_id = self.files.inverse.get(filename)
+        return other_id is not None and other_id != id
 
     def save(self, filename: pathlib.Path):
-        with open(filename, 'w') as f:
-            encoded = encoder.encode(self)
-            f.write(encoded)
-    
-    def load_files(filename) -> bidict.bidict:
+        save_json(filename, self, encoder)
+
+    def load_files(filename) -> BiDict:
         """Load the files from a document info file."""
-        with open(filename, 'r') as f:
+        with open(filename, 'rb') as f:
+            data = json.load(f)
+        return BiDict(data['files'])
+
+    def load_files_and_stats(filename) -> tuple:
+        """Load the files and the cached file stats from a document info file.
+        
+        The file stats map a file id to the size, modification time and checksum the file had when its checksum was 
+        last calculated."""
+        with open(filename, 'rb') as f:
             data = json.load(f)
-        return bidict.bidict(data['files'])
+        return BiDict(data['files']), data.get('file_stats', {})
 
-    def __init__(self, document: mendeley.models.documents.UserDocument, files: dict = {}):
+    def __init__(self, document: mendeley.models.documents.UserDocument, files: dict = None, file_stats: dict = None):
         self.document = document
-        self.files = bidict.bidict(files)
\ No newline at end of file
+        if files is None:
+            self.files = BiDict()
+        elif isinstance(files, BiDict):
+            self.files = files
+        else:
+            self.files = BiDict(files)
+        self.file_stats = {} if file_stats is None else file_stats
\ No newline at end of file
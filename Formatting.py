@@ -14,11 +14,11 @@
 # You should have received a copy of the GNU General Public License along
 # with this program.  If not, see <http://www.gnu.org/licenses/>. 
 
-import re
+import functools
 from string import Template
 
 def format_authors(authors):
-    if len(authors) == 0 or authors is None:
+    if not authors:
         return 'Unknown'
     if len(authors) == 1:
         return authors[0]
@@ -27,9 +27,10 @@ def format_authors(authors):
     else:
         return f'{authors[0]} et al.'
 
-escape_regexp = re.compile(r'[\/:*?"<>|]')
+invalid_characters_table = str.maketrans(dict.fromkeys('/:*?"<>|', '_'))
+@functools.lru_cache(maxsize=4096)
 def replace_invalid_characters(path):
-    return escape_regexp.sub('_', path)
+    return path.translate(invalid_characters_table)
 
 def escape_percent_signs(s):
     return s.replace('%', '%%')
@@ -39,6 +40,32 @@ class PercentTemplate(Template):
     """A string template with %-based substitution instead of $-based substitution."""
     delimiter = '%'
     
+    def _parse(self):
+        """Split the template into a list of (literal, placeholder) tuples. The placeholder of the last tuple can be 
+        None."""
+        parts = []
+        literal = ''
+        position = 0
+        for match in self.pattern.finditer(self.template):
+            literal += self.template[position:match.start()]
+            position = match.end()
+            if match.group('escaped') is not None:
+                literal += self.delimiter
+                continue
+            placeholder = match.group('named') or match.group('braced')
+            if placeholder is None:
+                self._invalid(match)
+            parts.append((literal, placeholder))
+            literal = ''
+        parts.append((literal + self.template[position:], None))
+        return parts
+
+    def format(self, mapping):
+        """Substitute the placeholders like substitute, but without parsing the template again."""
+        return ''.join(literal if placeholder is None else f'{literal}{mapping[placeholder]}'
+                       for literal, placeholder in self._parts)
+
     def __init__(self, template):
         Template.__init__(self, template)
-        self._identifiers = None
\ No newline at end of file
+        self._identifiers = None
+        self._parts = self._parse()
\ No newline at end of file
@@ -0,0 +1,45 @@
+#
+# Copyright (C) 2024 Tobe Deprez
+# 
+# This is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+ 
+# This file is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>. 
+
+import pathlib
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+#Large enough to write most info files in a single call
+WRITE_BUFFER_SIZE = 1024 * 1024
+
+def save_json(filename, obj, encoder, passthrough_datetime=False):
+    """Save obj as indented JSON, using orjson if it is available and the given JSON encoder otherwise.
+    
+    Args:
+        filename (pathlib.Path): The file to save to.
+        obj: The object to save.
+        encoder (json.JSONEncoder): The encoder to use. Its default method is also used for objects orjson can not 
+            serialize.
+        passthrough_datetime (bool): Whether orjson should pass datetime objects to the default method of the encoder 
+            instead of serializing them itself.
+    """
+    if orjson is not None:
+        option = orjson.OPT_INDENT_2
+        if passthrough_datetime:
+            option |= orjson.OPT_PASSTHROUGH_DATETIME
+        pathlib.Path(filename).write_bytes(orjson.dumps(obj, default=encoder.default, option=option))
+    else:
+        with open(filename, 'w', encoding='utf-8', buffering=WRITE_BUFFER_SIZE) as f:
+            for chunk in encoder.iterencode(obj):
+                f.write(chunk)
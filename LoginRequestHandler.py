@@ -14,58 +14,78 @@
 # You should have received a copy of the GNU General Public License along
 # with this program.  If not, see <http://www.gnu.org/licenses/>. 
 
+import html
 from http.server import BaseHTTPRequestHandler
 import urllib
 
+ERROR_PAGE_PREFIX = b'<html><body><h1>Failed to log in!</h1><p>'
+ERROR_PAGE_SUFFIX = b'</p></body></html>'
+
+def _build_response(status, body):
+    """Build a complete HTTP response, so it can be sent with a single write."""
+    return (f'HTTP/1.0 {status}\r\n'
+            'Content-Type: text/html\r\n'
+            f'Content-Length: {len(body)}\r\n'
+            'Connection: close\r\n'
+            '\r\n').encode() + body
+
 # Define request handler for local web server
 class LoginRequestHandler(BaseHTTPRequestHandler):
-    extra_body = ''
+    extra_body = b''
+
+    @classmethod
+    def _build_success_response(cls):
+        cls._success_response = _build_response('200 OK',
+                                                b'<html>'
+                                                b'  <body>'
+                                                b'    <h1>Successfully logged in!</h1>'
+                                                b'    <p>You can close this tab</p>' + 
+                                                cls.extra_body +
+                                                b'  </body>'
+                                                b'</html>')
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls._build_success_response()
 
     def log_message(self, format, *args):
         pass
 
     def do_GET(self):
-        url_parsed = urllib.parse.urlparse(self.path)
-        if url_parsed.query is not None:
-            query = urllib.parse.parse_qs(url_parsed.query)
+        self._url_parsed = urllib.parse.urlsplit(self.path)
+        if self._url_parsed.query:
+            query = urllib.parse.parse_qs(self._url_parsed.query)
             if 'error' in query:
-                self.send_response(500)
-                self.send_header('Content-type', 'text/html')
-                self.end_headers()
-                message = f'{query["error"][0]}: {query["error_description"][0]}'
-                self.wfile.write(b'<html><body><h1>Failed to log in!</h1>'
-                                 b'<p>' + message.encode() + b'</p></body></html>')
+                body = b''.join((ERROR_PAGE_PREFIX,
+                                 html.escape(query['error'][0]).encode(),
+                                 b': ',
+                                 html.escape(query.get('error_description', [''])[0]).encode(),
+                                 ERROR_PAGE_SUFFIX))
+                self.wfile.write(_build_response('500 Internal Server Error', body))
                 return
 
-        self.send_response(200)
-        self.send_header('Content-type', 'text/html')
-        self.end_headers()
-        self.wfile.write(b'<html>'
-                         b'  <body>'
-                         b'    <h1>Successfully logged in!</h1>'
-                         b'    <p>You can close this tab</p>' + 
-                         self.extra_body.encode() +
-                         b'  </body>'
-                         b'</html>')
+        self.wfile.write(self._success_response)
+
+LoginRequestHandler._build_success_response()
 
 class LoginRequestHandlerImplicit(LoginRequestHandler):
-    extra_body = '''<script>
-        if (window.location.hash != '') {
-            const xhttp = new XMLHttpRequest();
-            xhttp.open("GET", "oauth?" + window.location.hash.slice(1));
-            xhttp.send();
-        }
-    </script>'''
+    #Sends the token in the URL fragment, which the browser does not send itself, back to the server
+    extra_body = (b'<script>'
+                  b'if(window.location.hash!=""){'
+                  b'const xhttp=new XMLHttpRequest();'
+                  b'xhttp.open("GET","oauth?"+window.location.hash.slice(1));'
+                  b'xhttp.send();'
+                  b'}'
+                  b'</script>')
 
     def do_GET(self):
         super().do_GET()
-        url_parsed = urllib.parse.urlparse(self.path)
-        self.server.query_string = None
-        if url_parsed.query is not None and url_parsed.query != '':
-            self.server.query_string = url_parsed.query
+        if self._url_parsed.query:
+            self.server.result = self._url_parsed.query
 
 
 class LoginRequestHandlerAuthorizationCode(LoginRequestHandler):
     def do_GET(self):
         super().do_GET()
-        self.server.auth_response_path = self.path
\ No newline at end of file
+        if self._url_parsed.query:
+            self.server.result = self.path
\ No newline at end of file
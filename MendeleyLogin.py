@@ -14,47 +14,109 @@
 # You should have received a copy of the GNU General Public License along
 # with this program.  If not, see <http://www.gnu.org/licenses/>. 
 
+import functools
 from http.server import HTTPServer
 import json
 from LoginRequestHandler import LoginRequestHandlerImplicit, LoginRequestHandlerAuthorizationCode
 import mendeley
-from requests_oauthlib import OAuth2Session
+import os
+import selectors
+import tempfile
+import threading
 import urllib
-import webbrowser
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 #TODO: try to make it not print the requests to terminal
 #TODO: maybe switch to https://github.com/ipums/mendeley-python-sdk
 
+def load_token(token_file):
+    """Load a token that was saved before, or return None if the token file does not exist."""
+    try:
+        encoded = token_file.read_bytes()
+    except FileNotFoundError:
+        return None
+    return orjson.loads(encoded) if orjson is not None else json.loads(encoded)
+
+def _save_token(token_file, token):
+    """Save the token, replacing the token file only once the new token is completely written."""
+    token_file.parent.mkdir(parents=True, exist_ok=True)
+    encoded = orjson.dumps(token) if orjson is not None else json.dumps(token).encode()
+    #Every save gets its own temporary file, so that concurrent saves do not replace each other's file
+    with tempfile.NamedTemporaryFile(dir=token_file.parent, prefix=f'{token_file.name}.', suffix='.tmp',
+                                     delete=False) as f:
+        f.write(encoded)
+    try:
+        os.replace(f.name, token_file)
+    except OSError:
+        os.unlink(f.name)
+        raise
+
 class AuthorizationCodeTokenRefresher(mendeley.auth.MendeleyAuthorizationCodeTokenRefresher):
-    def refresh(self, *args, **kwargs):
-        super().refresh(*args, **kwargs)
-        if self.token_file is not None:
-            token_file.parent.mkdir(parents=True, exist_ok=True)
-            with open(self.token_file, 'w') as f:
-                json.dump(self.session.token, f)
+    def refresh(self, session):
+        #The session is shared by the backup threads, which can all find the token expired at the same time
+        expired_token = session.token
+        with self._lock:
+            if session.token is not expired_token:
+                #Another thread already refreshed the token
+                return
+            super().refresh(session)
+            if self.token_file is not None and session.token != self.saved_token:
+                _save_token(self.token_file, session.token)
+                self.saved_token = session.token
 
-    def __init__(self, token_file, *args, **kwargs):
+    def __init__(self, token_file, saved_token, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.token_file = token_file
+        self.saved_token = saved_token
+        self._lock = threading.Lock()
 
-def implicit_flow(client_id, redirect_uri):
-    """Login to mendeley using the implicit grant type and return a mendeley session object."""
+@functools.lru_cache(maxsize=2)
+def _get_mendeley(client_id, client_secret, redirect_uri):
+    """Get the mendeley client for the given application, reusing it when logging in again."""
+    return mendeley.Mendeley(client_id, client_secret, redirect_uri=redirect_uri)
+
+@functools.lru_cache(maxsize=4)
+def _parse_redirect_uri(redirect_uri):
+    """Parse the redirect URI and check that it uses http."""
     redirect_uri_parsed = urllib.parse.urlparse(redirect_uri, scheme='http')
     if not redirect_uri_parsed.scheme == 'http':
         raise ValueError('Redirect URI must be http')
+    return redirect_uri_parsed
+
+class LoginHTTPServer(HTTPServer):
+    #Allow restarting the program right away, even if the previous listening socket is still in TIME_WAIT
+    allow_reuse_address = True
+    #Wake up regularly while waiting, so a keyboard interrupt is handled promptly on every platform
+    timeout = 0.5
+
+def _receive_redirect(redirect_uri_parsed, request_handler_class):
+    """Serve requests on the redirect URI until the request handler stores the login result on the server and return 
+    that result."""
+    with LoginHTTPServer((redirect_uri_parsed.hostname, redirect_uri_parsed.port or 80), request_handler_class) as server:
+        server.result = None
+        with selectors.DefaultSelector() as selector:
+            selector.register(server, selectors.EVENT_READ)
+            while server.result is None:
+                if selector.select(server.timeout):
+                    server.handle_request()
+        return server.result
 
-    m = mendeley.Mendeley(client_id, redirect_uri=redirect_uri)
+def implicit_flow(client_id, redirect_uri):
+    """Login to mendeley using the implicit grant type and return a mendeley session object."""
+    redirect_uri_parsed = _parse_redirect_uri(redirect_uri)
+
+    m = _get_mendeley(client_id, None, redirect_uri)
     auth = m.start_implicit_grant_flow()
     login_uri = auth.get_login_url()
+    import webbrowser
     webbrowser.open(login_uri)
     print('A browser window will open to login to Mendeley. When you are done, the programm will continue.')
     
-    server = HTTPServer((redirect_uri_parsed.hostname, redirect_uri_parsed.port or 80), LoginRequestHandlerImplicit)
-    while True:
-        server.handle_request()
-        if server.query_string is not None:
-            break
-    auth_response = f'{redirect_uri}#{server.query_string}'
+    query_string = _receive_redirect(redirect_uri_parsed, LoginRequestHandlerImplicit)
+    auth_response = f'{redirect_uri}#{query_string}'
 
     return auth.authenticate(auth_response)
 
@@ -63,31 +125,30 @@ def authorization_code_flow(client_id, client_secret, redirect_uri, saved_token=
     """Login to mendeley using the authorization code grant type and return a mendeley session object.
     
     If saved_token is None, the user will be asked to login. If saved_token is not None, the refresh token will be 
-    used to login."""
-    redirect_uri_parsed = urllib.parse.urlparse(redirect_uri, scheme='http')
-    if not redirect_uri_parsed.scheme == 'http':
-        raise ValueError('Redirect URI must be http')
+    used to login. If token_file is not None, the token is written to it whenever a new token is obtained."""
+    redirect_uri_parsed = _parse_redirect_uri(redirect_uri)
     
-    m = mendeley.Mendeley(client_id, client_secret, redirect_uri=redirect_uri)
+    m = _get_mendeley(client_id, client_secret, redirect_uri)
     auth = m.start_authorization_code_flow()
     if saved_token is not None:
         auth.oauth.saved_token = saved_token
     else:
         login_uri = auth.get_login_url()
+        import webbrowser
         webbrowser.open(login_uri)
         print('A browser window will open to login to Mendeley. When you are done, the programm will continue.')
         
-        server = HTTPServer((redirect_uri_parsed.hostname, redirect_uri_parsed.port or 80),
-                            LoginRequestHandlerAuthorizationCode)
-        server.handle_request()
-        auth_response = urllib.parse.urlunparse(redirect_uri_parsed._replace(path=server.auth_response_path))
+        auth_response_path = _receive_redirect(redirect_uri_parsed, LoginRequestHandlerAuthorizationCode)
+        auth_response = urllib.parse.urlunparse(redirect_uri_parsed._replace(path=auth_response_path))
         
         saved_token = auth.oauth.fetch_token(auth.token_url, 
                                              authorization_response=auth_response,
                                              auth=auth.auth,
                                              scope=['all'])
+        if token_file is not None:
+            _save_token(token_file, saved_token)
     
     return mendeley.session.MendeleySession(m,
                                             saved_token,
                                             client=auth.client,
-                                            refresher=AuthorizationCodeTokenRefresher(token_file, auth))
\ No newline at end of file
+                                            refresher=AuthorizationCodeTokenRefresher(token_file, saved_token, auth))
\ No newline at end of file
@@ -18,18 +18,16 @@
 
 import argparse
 import appdirs
-import BackupWorker
-import configparser
 import Formatting
-import json
-import MendeleyLogin
 import pathlib
 import sys
 
 PROGRAM_NAME = 'mendeley-backup'
 DEFAULT_CLIENT_ID = 15049
 DEFAULT_REDIRECTION_URI = 'http://localhost:5000/oauth'
-DEFAULT_CONFIG_FILE = f'{appdirs.user_config_dir(PROGRAM_NAME)}/mendeley-backup.conf'
+CACHE_DIR = pathlib.Path(appdirs.user_cache_dir(PROGRAM_NAME))
+CONFIG_DIR = pathlib.Path(appdirs.user_config_dir(PROGRAM_NAME))
+DEFAULT_CONFIG_FILE = CONFIG_DIR.joinpath('mendeley-backup.conf')
 DEFAULT_TOKEN_FILE = f'token'
 DEFAULT_BACKUP_LOCATION = 'backup'
 DEFAULT_PATTERN = '%authors/%year - %title'
@@ -68,77 +66,83 @@ group.add_argument('-r', '--redirect-uri', dest='redirect_uri', metavar='URI',
 group.add_argument('-t', '--token-file', dest='token_file', metavar='FILE',
                     help=(f'The file where the OAuth token is stored if case a client secret is provided. '
                           f'The value is interpreted as a path relative to '
-                          f'\'{appdirs.user_cache_dir(PROGRAM_NAME)}\', unless an absolute path is provided. '
+                          f'\'{CACHE_DIR}\', unless an absolute path is provided. '
                           f'If this option is not provided, '
                           f'then the file specified in the configuration file is used, if any, or '
-                          f'\'{appdirs.user_cache_dir(PROGRAM_NAME)}/{DEFAULT_TOKEN_FILE}\'. Always store this file '
+                          f'\'{CACHE_DIR.joinpath(DEFAULT_TOKEN_FILE)}\'. Always store this file '
                           f'in a secure location!'))
 
-args = parser.parse_args()
+def main(argv=None, session=None):
+    """Run a backup with the given command line arguments.
 
-config_file = pathlib.Path(args.config_file or pathlib.Path(DEFAULT_CONFIG_FILE))
-client_id = DEFAULT_CLIENT_ID
-client_secret = None
-redirect_uri = DEFAULT_REDIRECTION_URI
-backup_location = DEFAULT_BACKUP_LOCATION
-pattern = DEFAULT_PATTERN
-token_file = DEFAULT_TOKEN_FILE
-if config_file.exists():
-    config = configparser.ConfigParser()
-    try:
-        with open(config_file, 'r') as f:
-            config.read_file(f)
-            if 'login-method' in config:
-                login_method = config['login-method']
-                client_id = login_method.getint('client-id', client_id)
-                client_secret = login_method.get('client-secret', None)
-                redirect_uri = login_method.get('redirect-uri', redirect_uri)
-                token_file = login_method.get('token-file', token_file)
-            if 'backup' in config:
-                backup = config['backup']
-                backup_location = backup.get('output-dir', backup_location)
-                pattern = backup.get('pattern', pattern)
-    except (configparser.Error, KeyError) as e:
-        print(f'Failed to parse configuration file: {e}', file=sys.stderr)
+    Args:
+        argv (list): The command line arguments, without the program name. Defaults to sys.argv[1:].
+        session (mendeley.session.MendeleySession): An existing session to use instead of logging in.
+    """
+    args = parser.parse_args(argv)
+
+    config_file = pathlib.Path(args.config_file or DEFAULT_CONFIG_FILE)
+    #The options that can be set both in the configuration file and on the command line, keyed by their argument name
+    options = {'client_id': DEFAULT_CLIENT_ID,
+               'client_secret': None,
+               'redirect_uri': DEFAULT_REDIRECTION_URI,
+               'output_dir': DEFAULT_BACKUP_LOCATION,
+               'pattern': DEFAULT_PATTERN,
+               'token_file': DEFAULT_TOKEN_FILE}
+    #The configuration file is not needed when every option is given on the command line
+    all_options_provided = all(getattr(args, key) is not None for key in options)
+    if not all_options_provided and config_file.exists():
+        #Only needed when there is a configuration file to parse
+        import configparser
+        config = configparser.ConfigParser()
+        try:
+            with open(config_file, 'r') as f:
+                config.read_file(f)
+                if 'login-method' in config:
+                    login_method = config['login-method']
+                    options['client_id'] = login_method.getint('client-id', options['client_id'])
+                    options['client_secret'] = login_method.get('client-secret', None)
+                    options['redirect_uri'] = login_method.get('redirect-uri', options['redirect_uri'])
+                    options['token_file'] = login_method.get('token-file', options['token_file'])
+                if 'backup' in config:
+                    backup = config['backup']
+                    options['output_dir'] = backup.get('output-dir', options['output_dir'])
+                    options['pattern'] = backup.get('pattern', options['pattern'])
+        except (configparser.Error, KeyError) as e:
+            print(f'Failed to parse configuration file: {e}', file=sys.stderr)
+            sys.exit(1)
+    options.update((key, value) for key, value in vars(args).items() if key in options and value is not None)
+    client_id = options['client_id']
+    client_secret = options['client_secret']
+    redirect_uri = options['redirect_uri']
+    pattern = options['pattern']
+    backup_location = pathlib.Path(options['output_dir'])
+    token_file = CACHE_DIR.joinpath(options['token_file'])
+
+    if backup_location is None:
+        print('No backup location specified. Provide either a backup location in the configuration file or with '
+              'the \'--output-dir\' option.', file=sys.stderr)
         sys.exit(1)
-if args.output_dir is not None:
-    backup_location = args.output_dir
-if args.pattern is not None:
-    pattern = args.pattern
-if args.token_file is not None:
-    token_file = args.token_file
-if args.client_id is not None:
-    client_id = args.client_id
-if args.client_secret is not None:
-    client_secret = args.client_secret
-if args.redirect_uri is not None:
-    redirect_uri = args.redirect_uri
-backup_location = pathlib.Path(backup_location)
-token_file = pathlib.Path(appdirs.user_cache_dir(PROGRAM_NAME)).joinpath(token_file)
 
-if backup_location is None:
-    print('No backup location specified. Provide either a backup location in the configuration file or with '
-          'the \'--output-dir\' option.', file=sys.stderr)
-    sys.exit(1)
+    #Only import the mendeley SDK and everything depending on it once the arguments are known to be valid
+    import BackupWorker
+    import MendeleyLogin
+
+    #TODO: at some point try to save the token using libsecret instead
+    if session is None:
+        if client_secret is None:
+            session = MendeleyLogin.implicit_flow(client_id, redirect_uri)
+        else:
+            token = MendeleyLogin.load_token(token_file)
+            session = MendeleyLogin.authorization_code_flow(str(client_id), client_secret, redirect_uri, token,
+                                                            token_file)
 
-#TODO: at some point try to save the token using libsecret instead
-if client_secret is None:
-    session = MendeleyLogin.implicit_flow(client_id, redirect_uri)
-else:
-    if token_file.exists():
-        with open(token_file, 'r') as f:
-            token = json.load(f)
-    else:
-        token = None
-    session = MendeleyLogin.authorization_code_flow(str(client_id), client_secret, redirect_uri, token)
-    if not token_file.exists():
-        token_file.parent.mkdir(parents=True, exist_ok=True)
-        with open(token_file, 'w') as f:
-            json.dump(session.token, f)
+    worker = BackupWorker.BackupWorker(mendeley_session=session, backup_location=backup_location, 
+                                       pattern=pattern)
+    history = worker.execute()
+    print(history.format_summary())
+    #TODO: when stopped in the middle, I should be able to continue where I left off (think about how to do it though)
+    #TODO: probably find a way to deal with two documents having the same name as according to the pattern
 
-worker = BackupWorker.BackupWorker(mendeley_session=session, backup_location=backup_location, 
-                                   pattern=pattern)
-history = worker.execute()
-print(history.format_summary())
-#TODO: when stopped in the middle, I should be able to continue where I left off (think about how to do it though)
-#TODO: probably find a way to deal with two documents having the same name as according to the pattern
\ No newline at end of file
+if __name__ == '__main__':
+    main()
@@ -14,65 +14,161 @@
 # You should have received a copy of the GNU General Public License along
 # with this program.  If not, see <http://www.gnu.org/licenses/>. 
 
+import concurrent.futures
 import configparser
-from datetime import datetime, timedelta
+import contextlib
+from datetime import datetime, timezone
+import functools
 import hashlib
+import importlib.util
+import io
 import json
 import mendeley
+import os
 import pathlib
 import re
 import unittest
-import shutil
-import subprocess
 import sys
+import threading
+import time
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
 
 sys.path.append(f'{pathlib.Path(__file__).parent.parent.parent}')
 import MendeleyLogin
 
+#The script can not be imported with an import statement because of the dash in its name
+_spec = importlib.util.spec_from_file_location('mendeley_backup',
+                                               pathlib.Path(__file__).parent.parent.parent.joinpath('mendeley-backup.py'))
+mendeley_backup = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(mendeley_backup)
+
 CONFIG_FILE = r'tests/integration-tests/mendeley-backup-tests.conf'
 OUTPUT_DIR = r'tests/integration-tests/backup'
+FILES_DIR = r'tests/integration-tests/files'
 TOKEN_FILE = rf'{pathlib.Path(__file__).parent.joinpath("token.json")}'
 OUTPUT_PATTERN = r'%authors/%year - %title'
 DOCUMENT_TITLE_PREFIX = 'mendeley-backup test document'
+MAX_WORKERS = 8
+HASH_BUFFER_SIZE = 64 * 1024
+
+SUMMARY_RE = re.compile(r'^(?P<count>[0-9]+) (?P<kind>new documents were added|documents were removed|'
+                        r'documents were updated|documents were moved and possibly updated)$', re.MULTILINE)
 
 def login():
+    config = configparser.ConfigParser()
     with open(CONFIG_FILE, 'r') as f:
-        config = configparser.ConfigParser()
-        with open(CONFIG_FILE, 'r') as f:
-            config.read_file(f)
-            login_method = config['login-method']
-            client_id = login_method.getint('client-id')
-            client_secret = login_method.get('client-secret')
-            redirect_uri = login_method.get('redirect-uri')
-        
-    if pathlib.Path(TOKEN_FILE).exists():
-        with open(TOKEN_FILE, 'r') as f:
-            token = json.load(f)
-    else:
-        token = None
-    session = MendeleyLogin.authorization_code_flow(str(client_id), client_secret, redirect_uri, token)
-    if not pathlib.Path(TOKEN_FILE).exists():
-        with open(TOKEN_FILE, 'w') as f:
-            json.dump(session.token, f)
+        config.read_file(f)
+    login_method = config['login-method']
+    client_id = login_method.getint('client-id')
+    client_secret = login_method.get('client-secret')
+    redirect_uri = login_method.get('redirect-uri')
+        
+    #The token is loaded and saved with orjson when it is available
+    token_file = pathlib.Path(TOKEN_FILE)
+    token = MendeleyLogin.load_token(token_file)
+    session = MendeleyLogin.authorization_code_flow(str(client_id), client_secret, redirect_uri, token, token_file)
     
     return session
 
 def clear_library(session):
-    for doc in session.documents.iter():
-        if not doc.title.startswith(DOCUMENT_TITLE_PREFIX):
-            raise Exception('The test library is not empty')
-        doc.delete()
+    docs = list(session.documents.iter())
+    if any(not doc.title.startswith(DOCUMENT_TITLE_PREFIX) for doc in docs):
+        raise Exception('The test library is not empty')
+    #Every delete is a separate request, so send them in parallel
+    with concurrent.futures.ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        for future in [executor.submit(doc.delete) for doc in docs]:
+            future.result()
+
+def remove_dir(dir):
+    """Remove a directory and everything in it."""
+    with os.scandir(dir) as entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                remove_dir(entry.path)
+            else:
+                os.unlink(entry.path)
+    os.rmdir(dir)
 
 def clear_backup():
-    shutil.rmtree(OUTPUT_DIR, ignore_errors=True)
+    try:
+        remove_dir(OUTPUT_DIR)
+    except FileNotFoundError:
+        pass
+
+#Files are hashed from several threads, so every thread gets its own read buffer
+_hash_buffers = threading.local()
+
+def _update_hash_from_file(hash, f):
+    """Feed a file to a hash by reading it into a reusable buffer."""
+    if not hasattr(_hash_buffers, 'buffer'):
+        _hash_buffers.buffer = bytearray(HASH_BUFFER_SIZE)
+    view = memoryview(_hash_buffers.buffer)
+    while (size := f.readinto(view)):
+        hash.update(view[:size])
 
 def hash(filename):
+    #Files are read into a reusable buffer instead of being memory mapped. This also avoids allocating per chunk, and
+    #works the same for empty files, which can not be mapped
+    hash = xxhash.xxh64() if xxhash is not None else hashlib.sha1()
+    with open(filename, 'rb', buffering=0) as f:
+        _update_hash_from_file(hash, f)
+    return hash.digest()
+
+def load_json(filename):
     with open(filename, 'rb') as f:
-        return hashlib.sha1(f.read()).hexdigest()
+        if orjson is not None:
+            return orjson.loads(f.read())
+        return json.load(f)
+
+@functools.lru_cache(maxsize=None)
+def fixture_hash(filename):
+    """Hash of a file in the test files directory. These never change, so they are only hashed once."""
+    return hash(pathlib.Path(FILES_DIR, filename))
+
+@functools.lru_cache(maxsize=None)
+def fixture_size(filename):
+    """Size of a file in the test files directory."""
+    return os.path.getsize(pathlib.Path(FILES_DIR, filename))
+
+def equals_fixture(path, filename):
+    """Whether a file has the same contents as the file with the given name in the test files directory.
+
+    The files are only hashed if their sizes are the same and they are not the same file.
+    """
+    size = os.path.getsize(path)
+    if size != fixture_size(filename):
+        return False
+    if size == 0 or os.path.samefile(path, pathlib.Path(FILES_DIR, filename)):
+        return True
+    return hash(path) == fixture_hash(filename)
 
 class IntegrationTests(unittest.TestCase):
+    TITLE_1 = f'{DOCUMENT_TITLE_PREFIX} 1'
+    TITLE_2 = f'{DOCUMENT_TITLE_PREFIX} 2'
+    TITLE_3 = f'{DOCUMENT_TITLE_PREFIX} 3'
+    #The locations of the documents relative to the output directory, as stored in the backup info
+    LOCATION_1 = f'Doe/2024 - {TITLE_1}'
+    LOCATION_2 = f'Doe & Doe/2024 - {TITLE_2}'
+    LOCATION_2_MOVED = f'Doe, Doe & Dow/2024 - {TITLE_2}'
+    LOCATION_3 = f'Doe/2024 - {TITLE_3}'
+    OUTPUT_PATH = pathlib.Path(OUTPUT_DIR)
+    DIR_1 = OUTPUT_PATH.joinpath(LOCATION_1)
+    DIR_2 = OUTPUT_PATH.joinpath(LOCATION_2)
+    DIR_2_MOVED = OUTPUT_PATH.joinpath(LOCATION_2_MOVED)
+    DIR_3 = OUTPUT_PATH.joinpath(LOCATION_3)
+
+    @classmethod
+    def setUpClass(cls):
+        cls.session = login()
+
     def setUp(self):
-        self.session = login()
         clear_library(self.session)
         clear_backup()
 
@@ -80,6 +176,13 @@ class IntegrationTests(unittest.TestCase):
         clear_library(self.session)
         clear_backup()
     
+    def run_backup(self):
+        """Run mendeley-backup in this process with the session of the tests and return what it printed."""
+        with contextlib.redirect_stdout(io.StringIO()) as output:
+            mendeley_backup.main(['--config-file', CONFIG_FILE, '--output-dir', OUTPUT_DIR, '--pattern', OUTPUT_PATTERN,
+                                  '--token-file', TOKEN_FILE], self.session)
+        return output.getvalue()
+
     def check_document(self, dir, title, type, authors, year, files):
         """Check whether the document in the directory has the correct info.json file and files.
         
@@ -92,272 +195,181 @@ class IntegrationTests(unittest.TestCase):
             files (set): A set of filenames of the document
         """
         self.assertTrue(dir.exists(), 'The directory of the document does not exist')
-        self.assertTrue(dir.joinpath('info.json').exists(), 'The info.json file of the document does not exist')
-        with open(dir.joinpath('info.json'), 'r') as f:
-            info = json.load(f)
-            document = info['document']
-            self.assertEqual(document['title'], title, 'The title of the document is incorrect')
-            self.assertEqual(document['type'], type, 'The type of the document is incorrect')
-            self.assertEqual(len(document['authors']), len(authors), 'The number of authors of the document is incorrect')
-            for i, (real_author, expected_author) in enumerate(zip(document['authors'], authors)):
-                self.assertEqual(real_author['first_name'], expected_author[0], 
-                                 f'The first name of the {i+1}th author of the document is incorrect')
-                self.assertEqual(real_author['last_name'], expected_author[1], 
-                                 f'The last name of the {i+1}th author of the document is incorrect')
-            self.assertEqual(document['year'], year, 'The year of the document is incorrect')
-            
-            self.assertEqual(len(info['files']), len(files), 'The number of files of the document is incorrect')
-            for filename in info['files'].values():
-                self.assertTrue(filename in files, f'The file {filename} is not in the document')
-                self.assertEqual(hash(dir.joinpath(filename)), 
-                                 hash(pathlib.Path(r'tests/integration-tests/files/', filename)),
-                                 f'The file {filename} was not downloaded correctly')
+        try:
+            info = load_json(dir.joinpath('info.json'))
+        except FileNotFoundError:
+            self.fail('The info.json file of the document does not exist')
+        document = info['document']
+        self.assertEqual(document['title'], title, 'The title of the document is incorrect')
+        self.assertEqual(document['type'], type, 'The type of the document is incorrect')
+        self.assertEqual([(author['first_name'], author['last_name']) for author in document['authors']], list(authors),
+                         'The authors of the document are incorrect')
+        self.assertEqual(document['year'], year, 'The year of the document is incorrect')
+        
+        self.assertEqual(len(info['files']), len(files), 'The number of files of the document is incorrect')
+        self.assertEqual(set(info['files'].values()), set(files), 'The files of the document are incorrect')
+        filenames = list(info['files'].values())
+        with concurrent.futures.ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+            equal = executor.map(equals_fixture, (dir.joinpath(filename) for filename in filenames), filenames)
+            incorrect_files = [filename for filename, file_equal in zip(filenames, equal) if not file_equal]
+        self.assertEqual(incorrect_files, [], 'The files were not downloaded correctly')
 
     def check_backup_info(self, expected_documents, expected_last_backup_time_lower):
-        output_path = pathlib.Path(OUTPUT_DIR)
-        with open(output_path.joinpath('info.json'), 'r') as f:
-            info = json.load(f)
-            self.assertEqual(info['pattern'], OUTPUT_PATTERN, 'The pattern is incorrect')
-            self.assertEqual(len(info['documents']), len(expected_documents), 'The number of documents is incorrect')
-            for document_location in info['documents'].values():
-                self.assertIn(document_location, expected_documents, 'Unexpected document')
-                expected_documents.remove(document_location)
-            
-            last_backup_time = datetime.fromisoformat(info['last_backup_time'])
-            self.assertLess(last_backup_time, datetime.utcnow(), 'The last backup time is incorrect')
-            self.assertGreater(last_backup_time, expected_last_backup_time_lower)
+        info = load_json(self.OUTPUT_PATH.joinpath('info.json'))
+        self.assertEqual(info['pattern'], OUTPUT_PATTERN, 'The pattern is incorrect')
+        self.assertEqual(len(info['documents']), len(expected_documents), 'The number of documents is incorrect')
+        self.assertEqual(set(info['documents'].values()), set(expected_documents), 'The documents are incorrect')
+        
+        #The last backup time is stored in UTC without a time zone
+        last_backup_time = datetime.fromisoformat(info['last_backup_time']).replace(tzinfo=timezone.utc).timestamp()
+        self.assertLess(last_backup_time, time.time(), 'The last backup time is incorrect')
+        self.assertGreater(last_backup_time, expected_last_backup_time_lower)
     
     def check_stdout(self, stdout, expected_nr_new_documents, expected_nr_removed_documents, expected_nr_updated_documents,
                      expected_nr_moved_documents):
-        match = re.search(r'^(?P<new>[0-9]+) new documents were added$', stdout, re.MULTILINE)
-        self.assertIsNotNone(match, 'The number of new documents was not printed')
-        self.assertEqual(int(match.group('new')), expected_nr_new_documents, 
-                         'The number of new documents is incorrect')
-
-        match = re.search(r'^(?P<removed>[0-9]+) documents were removed$', stdout, re.MULTILINE)
-        self.assertIsNotNone(match, 'The number of removed documents was not printed')
-        self.assertEqual(int(match.group('removed')), expected_nr_removed_documents,
-                            'The number of removed documents is incorrect')
-
-        match = re.search(r'^(?P<updated>[0-9]+) documents were updated$', stdout, re.MULTILINE)
-        self.assertIsNotNone(match, 'The number of updated documents was not printed')
-        self.assertEqual(int(match.group('updated')), expected_nr_updated_documents,
-                            'The number of updated documents is incorrect')
-
-        match = re.search(r'^(?P<moved>[0-9]+) documents were moved and possibly updated$', stdout, re.MULTILINE)
-        self.assertIsNotNone(match, 'The number of moved documents was not printed')
-        self.assertEqual(int(match.group('moved')), expected_nr_moved_documents,
-                            'The number of moved documents is incorrect')
+        counts = {match.group('kind'): int(match.group('count')) for match in SUMMARY_RE.finditer(stdout)}
+        for kind, expected, name in [('new documents were added', expected_nr_new_documents, 'new'),
+                                     ('documents were removed', expected_nr_removed_documents, 'removed'),
+                                     ('documents were updated', expected_nr_updated_documents, 'updated'),
+                                     ('documents were moved and possibly updated', expected_nr_moved_documents, 'moved')]:
+            self.assertIn(kind, counts, f'The number of {name} documents was not printed')
+            self.assertEqual(counts[kind], expected, f'The number of {name} documents is incorrect')
 
     
+    def run_backup_and_check(self, expected_counts, expected_documents=None, documents=()):
+        """Run a backup and check the output, the backup info and the given documents.
+
+        Args:
+            expected_counts (tuple): The expected number of new, removed, updated and moved documents.
+            expected_documents (list): The expected locations of all documents, or None to not check the backup info.
+            documents (list): A list of tuples with the arguments of check_document for each document to check.
+        """
+        expected_last_backup_time_lower = time.time()
+        output = self.run_backup()
+        self.check_stdout(output, *expected_counts)
+        self.assertTrue(self.OUTPUT_PATH.exists(), 'The output directory does not exist')
+        if expected_documents is not None:
+            self.check_backup_info(expected_documents, expected_last_backup_time_lower)
+        for document in documents:
+            self.check_document(*document)
+
     def test_initial_backup(self):
-        doc = self.session.documents.create(title=f'{DOCUMENT_TITLE_PREFIX} 1', type='working_paper', 
+        doc = self.session.documents.create(title=self.TITLE_1, type='working_paper', 
                                        authors=[mendeley.models.common.Person.create(first_name='John', last_name='Doe')],
                                        year=2024)
         doc.attach_file(r'tests/integration-tests/files/document1.pdf')
 
-        doc = self.session.documents.create(title=f'{DOCUMENT_TITLE_PREFIX} 2', type='working_paper', 
+        doc = self.session.documents.create(title=self.TITLE_2, type='working_paper', 
                                        authors=[mendeley.models.common.Person.create(first_name='John', last_name='Doe'),
                                                 mendeley.models.common.Person.create(first_name='Jane', last_name='Doe')],
                                        year=2024)
 
-        doc = self.session.documents.create(title=f'{DOCUMENT_TITLE_PREFIX} 3', type='working_paper', 
+        doc = self.session.documents.create(title=self.TITLE_3, type='working_paper', 
                                        authors=[mendeley.models.common.Person.create(first_name='John', last_name='Doe')],
                                        year=2024)
         doc.attach_file(r'tests/integration-tests/files/document3.pdf')
         doc.attach_file(r'tests/integration-tests/files/document32.pdf')
 
-        expected_last_backup_time_lower = datetime.utcnow()
-        output = subprocess.check_output(['python3', 'mendeley-backup.py', '--config-file', CONFIG_FILE, 
-                                          '--output-dir', OUTPUT_DIR, '--pattern', OUTPUT_PATTERN,
-                                          '--token-file', TOKEN_FILE])
-        self.check_stdout(output.decode('utf-8'), 3, 0, 0, 0)
-        
-        self.assertTrue(pathlib.Path(OUTPUT_DIR).exists(), 'The output directory does not exist')
-        output_path = pathlib.Path(OUTPUT_DIR)
-        
-        self.check_backup_info([f'Doe/2024 - {DOCUMENT_TITLE_PREFIX} 1',
-                                f'Doe & Doe/2024 - {DOCUMENT_TITLE_PREFIX} 2',
-                                f'Doe/2024 - {DOCUMENT_TITLE_PREFIX} 3'],
-                                expected_last_backup_time_lower)
-
-        self.check_document(output_path.joinpath('Doe', f'2024 - {DOCUMENT_TITLE_PREFIX} 1'),
-                            f'{DOCUMENT_TITLE_PREFIX} 1', 'working_paper', [('John', 'Doe')], 2024, {'document1.pdf'})
-        self.check_document(output_path.joinpath('Doe & Doe', f'2024 - {DOCUMENT_TITLE_PREFIX} 2'),
-                            f'{DOCUMENT_TITLE_PREFIX} 2', 'working_paper', [('John', 'Doe'), ('Jane', 'Doe')], 2024, set())
-        self.check_document(output_path.joinpath('Doe', f'2024 - {DOCUMENT_TITLE_PREFIX} 3'),
-                            f'{DOCUMENT_TITLE_PREFIX} 3', 'working_paper', [('John', 'Doe')], 2024, 
-                            {'document3.pdf', 'document32.pdf'})
+        self.run_backup_and_check((3, 0, 0, 0),
+                                  [self.LOCATION_1, self.LOCATION_2, self.LOCATION_3],
+                                  [(self.DIR_1, self.TITLE_1, 'working_paper', [('John', 'Doe')], 2024,
+                                    {'document1.pdf'}),
+                                   (self.DIR_2, self.TITLE_2, 'working_paper', [('John', 'Doe'), ('Jane', 'Doe')], 2024,
+                                    set()),
+                                   (self.DIR_3, self.TITLE_3, 'working_paper', [('John', 'Doe')], 2024,
+                                    {'document3.pdf', 'document32.pdf'})])
         
     def test_document_added(self):
         #Initial setup
-        doc = self.session.documents.create(title=f'{DOCUMENT_TITLE_PREFIX} 1', type='working_paper', 
+        doc = self.session.documents.create(title=self.TITLE_1, type='working_paper', 
                                        authors=[mendeley.models.common.Person.create(first_name='John', last_name='Doe')],
                                        year=2024)
         doc.attach_file(r'tests/integration-tests/files/document1.pdf')
 
-        expected_last_backup_time_lower = datetime.utcnow()
-        output = subprocess.check_output(['python3', 'mendeley-backup.py', '--config-file', CONFIG_FILE, 
-                                          '--output-dir', OUTPUT_DIR, '--pattern', OUTPUT_PATTERN,
-                                          '--token-file', TOKEN_FILE])
-        self.check_stdout(output.decode('utf-8'), 1, 0, 0, 0)
-
-        self.assertTrue(pathlib.Path(OUTPUT_DIR).exists(), 'The output directory does not exist')
-        output_path = pathlib.Path(OUTPUT_DIR)
-        
-        self.check_backup_info([f'Doe/2024 - {DOCUMENT_TITLE_PREFIX} 1'],
-                                expected_last_backup_time_lower=expected_last_backup_time_lower)
-
-        self.check_document(output_path.joinpath('Doe', f'2024 - {DOCUMENT_TITLE_PREFIX} 1'),
-                            f'{DOCUMENT_TITLE_PREFIX} 1', 'working_paper', [('John', 'Doe')], 2024, {'document1.pdf'})
+        document1 = (self.DIR_1, self.TITLE_1, 'working_paper', [('John', 'Doe')], 2024, {'document1.pdf'})
+        self.run_backup_and_check((1, 0, 0, 0), [self.LOCATION_1], [document1])
         
         #Add a new document without any files
-        self.session.documents.create(title=f'{DOCUMENT_TITLE_PREFIX} 2', type='working_paper', 
+        self.session.documents.create(title=self.TITLE_2, type='working_paper', 
                                        authors=[mendeley.models.common.Person.create(first_name='John', last_name='Doe'),
                                                 mendeley.models.common.Person.create(first_name='Jane', last_name='Doe')],
                                        year=2024)
         
-        expected_last_backup_time_lower = datetime.utcnow()
-        output = subprocess.check_output(['python3', 'mendeley-backup.py', '--config-file', CONFIG_FILE, 
-                                          '--output-dir', OUTPUT_DIR, '--pattern', OUTPUT_PATTERN,
-                                          '--token-file', TOKEN_FILE])
-        self.check_stdout(output.decode('utf-8'), 1, 0, 0, 0)
-        
-        self.check_backup_info([f'Doe/2024 - {DOCUMENT_TITLE_PREFIX} 1',
-                                f'Doe & Doe/2024 - {DOCUMENT_TITLE_PREFIX} 2'],
-                                expected_last_backup_time_lower=expected_last_backup_time_lower)
-        
-        self.check_document(output_path.joinpath('Doe', f'2024 - {DOCUMENT_TITLE_PREFIX} 1'),
-                            f'{DOCUMENT_TITLE_PREFIX} 1', 'working_paper', [('John', 'Doe')], 2024, {'document1.pdf'})
-        self.check_document(output_path.joinpath('Doe & Doe', f'2024 - {DOCUMENT_TITLE_PREFIX} 2'),
-                            f'{DOCUMENT_TITLE_PREFIX} 2', 'working_paper', [('John', 'Doe'), ('Jane', 'Doe')], 2024, set())
+        document2 = (self.DIR_2, self.TITLE_2, 'working_paper', [('John', 'Doe'), ('Jane', 'Doe')], 2024, set())
+        self.run_backup_and_check((1, 0, 0, 0),
+                                  [self.LOCATION_1, self.LOCATION_2],
+                                  [document1, document2])
         
         #Add a new document with two files
-        doc = self.session.documents.create(title=f'{DOCUMENT_TITLE_PREFIX} 3', type='working_paper', 
+        doc = self.session.documents.create(title=self.TITLE_3, type='working_paper', 
                                        authors=[mendeley.models.common.Person.create(first_name='John', last_name='Doe')],
                                        year=2024)
         doc.attach_file(r'tests/integration-tests/files/document3.pdf')
         doc.attach_file(r'tests/integration-tests/files/document32.pdf')
 
-        expected_last_backup_time_lower = datetime.utcnow()
-        output = subprocess.check_output(['python3', 'mendeley-backup.py', '--config-file', CONFIG_FILE, 
-                                          '--output-dir', OUTPUT_DIR, '--pattern', OUTPUT_PATTERN,
-                                          '--token-file', TOKEN_FILE])
-        self.check_stdout(output.decode('utf-8'), 1, 0, 0, 0)
-        
-        self.assertTrue(pathlib.Path(OUTPUT_DIR).exists(), 'The output directory does not exist')
-        output_path = pathlib.Path(OUTPUT_DIR)
-        
-        self.check_backup_info([f'Doe/2024 - {DOCUMENT_TITLE_PREFIX} 1',
-                                f'Doe & Doe/2024 - {DOCUMENT_TITLE_PREFIX} 2',
-                                f'Doe/2024 - {DOCUMENT_TITLE_PREFIX} 3'],
-                                expected_last_backup_time_lower)
-
-        self.check_document(output_path.joinpath('Doe', f'2024 - {DOCUMENT_TITLE_PREFIX} 1'),
-                            f'{DOCUMENT_TITLE_PREFIX} 1', 'working_paper', [('John', 'Doe')], 2024, {'document1.pdf'})
-        self.check_document(output_path.joinpath('Doe & Doe', f'2024 - {DOCUMENT_TITLE_PREFIX} 2'),
-                            f'{DOCUMENT_TITLE_PREFIX} 2', 'working_paper', [('John', 'Doe'), ('Jane', 'Doe')], 2024, set())
-        self.check_document(output_path.joinpath('Doe', f'2024 - {DOCUMENT_TITLE_PREFIX} 3'),
-                            f'{DOCUMENT_TITLE_PREFIX} 3', 'working_paper', [('John', 'Doe')], 2024, 
-                            {'document3.pdf', 'document32.pdf'})
+        document3 = (self.DIR_3, self.TITLE_3, 'working_paper', [('John', 'Doe')], 2024,
+                     {'document3.pdf', 'document32.pdf'})
+        self.run_backup_and_check((1, 0, 0, 0),
+                                  [self.LOCATION_1, self.LOCATION_2, self.LOCATION_3],
+                                  [document1, document2, document3])
 
-
-    
     def test_document_removal(self):
         #Initial setup
-        doc1 = self.session.documents.create(title=f'{DOCUMENT_TITLE_PREFIX} 1', type='working_paper', 
+        doc1 = self.session.documents.create(title=self.TITLE_1, type='working_paper', 
                                        authors=[mendeley.models.common.Person.create(first_name='John', last_name='Doe')],
                                        year=2024)
         doc1.attach_file(r'tests/integration-tests/files/document1.pdf')
 
-        doc2 = self.session.documents.create(title=f'{DOCUMENT_TITLE_PREFIX} 2', type='working_paper', 
+        doc2 = self.session.documents.create(title=self.TITLE_2, type='working_paper', 
                                        authors=[mendeley.models.common.Person.create(first_name='John', last_name='Doe'),
                                                 mendeley.models.common.Person.create(first_name='Jane', last_name='Doe')],
                                        year=2024)
         
-        expected_last_backup_time_lower = datetime.utcnow()
-        output = subprocess.check_output(['python3', 'mendeley-backup.py', '--config-file', CONFIG_FILE, 
-                                          '--output-dir', OUTPUT_DIR, '--pattern', OUTPUT_PATTERN,
-                                          '--token-file', TOKEN_FILE])
-        self.check_stdout(output.decode('utf-8'), 2, 0, 0, 0)
-        
-        self.assertTrue(pathlib.Path(OUTPUT_DIR).exists(), 'The output directory does not exist')
-        output_path = pathlib.Path(OUTPUT_DIR)
-        
-        self.check_backup_info([f'Doe/2024 - {DOCUMENT_TITLE_PREFIX} 1',
-                                f'Doe & Doe/2024 - {DOCUMENT_TITLE_PREFIX} 2'],
-                                expected_last_backup_time_lower=expected_last_backup_time_lower)
-
-        self.check_document(output_path.joinpath('Doe', f'2024 - {DOCUMENT_TITLE_PREFIX} 1'),
-                            f'{DOCUMENT_TITLE_PREFIX} 1', 'working_paper', [('John', 'Doe')], 2024, {'document1.pdf'})
-        self.check_document(output_path.joinpath('Doe & Doe', f'2024 - {DOCUMENT_TITLE_PREFIX} 2'),
-                            f'{DOCUMENT_TITLE_PREFIX} 2', 'working_paper', [('John', 'Doe'), ('Jane', 'Doe')], 2024, set())
+        document1 = (self.DIR_1, self.TITLE_1, 'working_paper', [('John', 'Doe')], 2024, {'document1.pdf'})
+        document2 = (self.DIR_2, self.TITLE_2, 'working_paper', [('John', 'Doe'), ('Jane', 'Doe')], 2024, set())
+        self.run_backup_and_check((2, 0, 0, 0),
+                                  [self.LOCATION_1, self.LOCATION_2],
+                                  [document1, document2])
         
         #Delete document 1
         doc1.delete()
-        expected_last_backup_time_lower = datetime.utcnow()
-        output = subprocess.check_output(['python3', 'mendeley-backup.py', '--config-file', CONFIG_FILE, 
-                                          '--output-dir', OUTPUT_DIR, '--pattern', OUTPUT_PATTERN,
-                                          '--token-file', TOKEN_FILE])
-        self.check_stdout(output.decode('utf-8'), 0, 1, 0, 0)
-        self.check_backup_info([f'Doe & Doe/2024 - {DOCUMENT_TITLE_PREFIX} 2'],
-                               expected_last_backup_time_lower=expected_last_backup_time_lower)
-        self.check_document(output_path.joinpath('Doe & Doe', f'2024 - {DOCUMENT_TITLE_PREFIX} 2'),
-                            f'{DOCUMENT_TITLE_PREFIX} 2', 'working_paper', [('John', 'Doe'), ('Jane', 'Doe')], 2024, set())
-        self.assertFalse(output_path.joinpath('Doe', f'2024 - {DOCUMENT_TITLE_PREFIX} 1').exists(),
+        self.run_backup_and_check((0, 1, 0, 0), [self.LOCATION_2], [document2])
+        self.assertFalse(self.DIR_1.exists(),
                             'Document 1 was not removed')
 
         #Move document 2 to trash
         doc2.move_to_trash()
-        expected_last_backup_time_lower = datetime.utcnow()
-        output = subprocess.check_output(['python3', 'mendeley-backup.py', '--config-file', CONFIG_FILE, 
-                                          '--output-dir', OUTPUT_DIR, '--pattern', OUTPUT_PATTERN,
-                                          '--token-file', TOKEN_FILE])
-        self.check_stdout(output.decode('utf-8'), 0, 1, 0, 0)
-        self.check_backup_info([],
-                               expected_last_backup_time_lower=expected_last_backup_time_lower)
-        self.assertFalse(output_path.joinpath('Doe & Doe', f'2024 - {DOCUMENT_TITLE_PREFIX} 2').exists(),
+        self.run_backup_and_check((0, 1, 0, 0), [])
+        self.assertFalse(self.DIR_2.exists(),
                             'Document 2 was not removed')
 
     def test_document_update(self):
         #Initial setup
-        doc1 = self.session.documents.create(title=f'{DOCUMENT_TITLE_PREFIX} 1', type='working_paper', 
+        doc1 = self.session.documents.create(title=self.TITLE_1, type='working_paper', 
                                        authors=[mendeley.models.common.Person.create(first_name='John', last_name='Doe')],
                                        year=2024)
         doc1.attach_file(r'tests/integration-tests/files/document1.pdf')
 
-        doc2 = self.session.documents.create(title=f'{DOCUMENT_TITLE_PREFIX} 2', type='working_paper', 
+        doc2 = self.session.documents.create(title=self.TITLE_2, type='working_paper', 
                                        authors=[mendeley.models.common.Person.create(first_name='John', last_name='Doe'),
                                                 mendeley.models.common.Person.create(first_name='Jane', last_name='Doe')],
                                        year=2024)
 
-        doc3 = self.session.documents.create(title=f'{DOCUMENT_TITLE_PREFIX} 3', type='working_paper', 
+        doc3 = self.session.documents.create(title=self.TITLE_3, type='working_paper', 
                                        authors=[mendeley.models.common.Person.create(first_name='John', last_name='Doe')],
                                        year=2024)
         doc3.attach_file(r'tests/integration-tests/files/document3.pdf')
         doc3.attach_file(r'tests/integration-tests/files/document32.pdf')
 
-        expected_last_backup_time_lower = datetime.utcnow()
-        output = subprocess.check_output(['python3', 'mendeley-backup.py', '--config-file', CONFIG_FILE, 
-                                          '--output-dir', OUTPUT_DIR, '--pattern', OUTPUT_PATTERN,
-                                          '--token-file', TOKEN_FILE])
-        self.check_stdout(output.decode('utf-8'), 3, 0, 0, 0)
-        
-        self.assertTrue(pathlib.Path(OUTPUT_DIR).exists(), 'The output directory does not exist')
-        output_path = pathlib.Path(OUTPUT_DIR)
-        
-        self.check_backup_info([f'Doe/2024 - {DOCUMENT_TITLE_PREFIX} 1',
-                                f'Doe & Doe/2024 - {DOCUMENT_TITLE_PREFIX} 2',
-                                f'Doe/2024 - {DOCUMENT_TITLE_PREFIX} 3'],
-                                expected_last_backup_time_lower)
-
-        self.check_document(output_path.joinpath('Doe', f'2024 - {DOCUMENT_TITLE_PREFIX} 1'),
-                            f'{DOCUMENT_TITLE_PREFIX} 1', 'working_paper', [('John', 'Doe')], 2024, {'document1.pdf'})
-        self.check_document(output_path.joinpath('Doe & Doe', f'2024 - {DOCUMENT_TITLE_PREFIX} 2'),
-                            f'{DOCUMENT_TITLE_PREFIX} 2', 'working_paper', [('John', 'Doe'), ('Jane', 'Doe')], 2024, set())
-        self.check_document(output_path.joinpath('Doe', f'2024 - {DOCUMENT_TITLE_PREFIX} 3'),
-                            f'{DOCUMENT_TITLE_PREFIX} 3', 'working_paper', [('John', 'Doe')], 2024, 
-                            {'document3.pdf', 'document32.pdf'})
+        document3 = (self.DIR_3, self.TITLE_3, 'working_paper', [('John', 'Doe')], 2024,
+                     {'document3.pdf', 'document32.pdf'})
+        self.run_backup_and_check((3, 0, 0, 0),
+                                  [self.LOCATION_1, self.LOCATION_2, self.LOCATION_3],
+                                  [(self.DIR_1, self.TITLE_1, 'working_paper', [('John', 'Doe')], 2024,
+                                    {'document1.pdf'}),
+                                   (self.DIR_2, self.TITLE_2, 'working_paper', [('John', 'Doe'), ('Jane', 'Doe')], 2024,
+                                    set()),
+                                   document3])
         
         #Update type of document 1 and add an author to document 2
         doc1.update(type = 'generic')
@@ -366,118 +378,63 @@ class IntegrationTests(unittest.TestCase):
         doc2_authors.append(mendeley.models.common.Person.create(first_name='Jannet', last_name='Dow'))
         doc2.update(authors=doc2_authors)
 
-        expected_last_backup_time_lower = datetime.utcnow()
-        output = subprocess.check_output(['python3', 'mendeley-backup.py', '--config-file', CONFIG_FILE, 
-                                          '--output-dir', OUTPUT_DIR, '--pattern', OUTPUT_PATTERN,
-                                          '--token-file', TOKEN_FILE])
-        self.check_stdout(output.decode('utf-8'), 0, 0, 1, 1)
-        
-        self.assertTrue(pathlib.Path(OUTPUT_DIR).exists(), 'The output directory does not exist')
-        output_path = pathlib.Path(OUTPUT_DIR)
-        
-        self.check_backup_info([f'Doe/2024 - {DOCUMENT_TITLE_PREFIX} 1',
-                                f'Doe, Doe & Dow/2024 - {DOCUMENT_TITLE_PREFIX} 2',
-                                f'Doe/2024 - {DOCUMENT_TITLE_PREFIX} 3'],
-                                expected_last_backup_time_lower)
-
-        self.check_document(output_path.joinpath('Doe', f'2024 - {DOCUMENT_TITLE_PREFIX} 1'),
-                            f'{DOCUMENT_TITLE_PREFIX} 1', 'generic', [('John', 'Doe')], 2024, {'document1.pdf'})
-        self.assertFalse(output_path.joinpath('Doe & Doe', f'2024 - {DOCUMENT_TITLE_PREFIX} 2').exists(), 
+        self.run_backup_and_check((0, 0, 1, 1),
+                                  [self.LOCATION_1, self.LOCATION_2_MOVED, self.LOCATION_3],
+                                  [(self.DIR_1, self.TITLE_1, 'generic', [('John', 'Doe')], 2024, {'document1.pdf'}),
+                                   (self.DIR_2_MOVED, self.TITLE_2, 'working_paper', 
+                                    [('John', 'Doe'), ('Jane', 'Doe'), ('Jannet', 'Dow')], 2024, set()),
+                                   document3])
+        self.assertFalse(self.DIR_2.exists(), 
                          'The document was not moved')
-        self.check_document(output_path.joinpath('Doe, Doe & Dow', f'2024 - {DOCUMENT_TITLE_PREFIX} 2'),
-                            f'{DOCUMENT_TITLE_PREFIX} 2', 'working_paper', 
-                            [('John', 'Doe'), ('Jane', 'Doe'), ('Jannet', 'Dow')], 2024, set())
-        self.check_document(output_path.joinpath('Doe', f'2024 - {DOCUMENT_TITLE_PREFIX} 3'),
-                            f'{DOCUMENT_TITLE_PREFIX} 3', 'working_paper', [('John', 'Doe')], 2024, 
-                            {'document3.pdf', 'document32.pdf'})
 
     def test_file_added(self):
         #Initial setup
-        doc = self.session.documents.create(title=f'{DOCUMENT_TITLE_PREFIX} 3', type='working_paper', 
+        doc = self.session.documents.create(title=self.TITLE_3, type='working_paper', 
                                        authors=[mendeley.models.common.Person.create(first_name='John', last_name='Doe')],
                                        year=2024)
         doc.attach_file(r'tests/integration-tests/files/document3.pdf')
 
-        expected_last_backup_time_lower = datetime.utcnow()
-        output = subprocess.check_output(['python3', 'mendeley-backup.py', '--config-file', CONFIG_FILE, 
-                                          '--output-dir', OUTPUT_DIR, '--pattern', OUTPUT_PATTERN,
-                                          '--token-file', TOKEN_FILE])
-        self.check_stdout(output.decode('utf-8'), 1, 0, 0, 0)
-        
-        self.assertTrue(pathlib.Path(OUTPUT_DIR).exists(), 'The output directory does not exist')
-        output_path = pathlib.Path(OUTPUT_DIR)
-        
-        self.check_backup_info([f'Doe/2024 - {DOCUMENT_TITLE_PREFIX} 3'],
-                                expected_last_backup_time_lower)
-        
-        self.check_document(output_path.joinpath('Doe', f'2024 - {DOCUMENT_TITLE_PREFIX} 3'),
-                            f'{DOCUMENT_TITLE_PREFIX} 3', 'working_paper', [('John', 'Doe')], 2024, 
-                            {'document3.pdf'})
+        self.run_backup_and_check((1, 0, 0, 0), [self.LOCATION_3],
+                                  [(self.DIR_3, self.TITLE_3, 'working_paper', [('John', 'Doe')], 2024, 
+                                    {'document3.pdf'})])
         
         #Add a file to the document
         doc.attach_file(r'tests/integration-tests/files/document32.pdf')
 
-        expected_last_backup_time_lower = datetime.utcnow()
-        output = subprocess.check_output(['python3', 'mendeley-backup.py', '--config-file', CONFIG_FILE, 
-                                          '--output-dir', OUTPUT_DIR, '--pattern', OUTPUT_PATTERN,
-                                          '--token-file', TOKEN_FILE])
-        self.check_stdout(output.decode('utf-8'), 0, 0, 1, 0)
-        self.check_document(output_path.joinpath('Doe', f'2024 - {DOCUMENT_TITLE_PREFIX} 3'),
-                            f'{DOCUMENT_TITLE_PREFIX} 3', 'working_paper', [('John', 'Doe')], 2024, 
-                            {'document3.pdf', 'document32.pdf'})
+        self.run_backup_and_check((0, 0, 1, 0), None,
+                                  [(self.DIR_3, self.TITLE_3, 'working_paper', [('John', 'Doe')], 2024, 
+                                    {'document3.pdf', 'document32.pdf'})])
         
     def test_file_removed(self):
         #Initial setup
-        doc = self.session.documents.create(title=f'{DOCUMENT_TITLE_PREFIX} 3', type='working_paper', 
+        doc = self.session.documents.create(title=self.TITLE_3, type='working_paper', 
                                        authors=[mendeley.models.common.Person.create(first_name='John', last_name='Doe')],
                                        year=2024)
         doc.attach_file(r'tests/integration-tests/files/document3.pdf')
         doc.attach_file(r'tests/integration-tests/files/document32.pdf')
 
-        expected_last_backup_time_lower = datetime.utcnow()
-        output = subprocess.check_output(['python3', 'mendeley-backup.py', '--config-file', CONFIG_FILE, 
-                                          '--output-dir', OUTPUT_DIR, '--pattern', OUTPUT_PATTERN,
-                                          '--token-file', TOKEN_FILE])
-        self.check_stdout(output.decode('utf-8'), 1, 0, 0, 0)
-        
-        self.assertTrue(pathlib.Path(OUTPUT_DIR).exists(), 'The output directory does not exist')
-        output_path = pathlib.Path(OUTPUT_DIR)
-        
-        self.check_backup_info([f'Doe/2024 - {DOCUMENT_TITLE_PREFIX} 3'],
-                                expected_last_backup_time_lower)
-        
-        self.check_document(output_path.joinpath('Doe', f'2024 - {DOCUMENT_TITLE_PREFIX} 3'),
-                            f'{DOCUMENT_TITLE_PREFIX} 3', 'working_paper', [('John', 'Doe')], 2024, 
-                            {'document3.pdf', 'document32.pdf'})
+        self.run_backup_and_check((1, 0, 0, 0), [self.LOCATION_3],
+                                  [(self.DIR_3, self.TITLE_3, 'working_paper', [('John', 'Doe')], 2024, 
+                                    {'document3.pdf', 'document32.pdf'})])
         
         #Remove file document3.pdf
         file = next(x for x in doc.files.iter() if x.file_name == 'document3.pdf')
         file.delete()
 
-        expected_last_backup_time_lower = datetime.utcnow()
-        output = subprocess.check_output(['python3', 'mendeley-backup.py', '--config-file', CONFIG_FILE, 
-                                          '--output-dir', OUTPUT_DIR, '--pattern', OUTPUT_PATTERN,
-                                          '--token-file', TOKEN_FILE])
-        self.check_stdout(output.decode('utf-8'), 0, 0, 1, 0)
-        self.check_document(output_path.joinpath('Doe', f'2024 - {DOCUMENT_TITLE_PREFIX} 3'),
-                            f'{DOCUMENT_TITLE_PREFIX} 3', 'working_paper', [('John', 'Doe')], 2024, 
-                            {'document32.pdf'})
-        self.assertFalse(output_path.joinpath('Doe', f'2024 - {DOCUMENT_TITLE_PREFIX} 3', 'document3.pdf').exists(),
+        self.run_backup_and_check((0, 0, 1, 0), None,
+                                  [(self.DIR_3, self.TITLE_3, 'working_paper', [('John', 'Doe')], 2024, 
+                                    {'document32.pdf'})])
+        self.assertFalse(self.DIR_3.joinpath('document3.pdf').exists(),
                          'The file document3.pdf was not removed')
         
         #Remove file document32.pdf
         file = next(x for x in doc.files.iter() if x.file_name == 'document32.pdf')
         file.delete()
 
-        expected_last_backup_time_lower = datetime.utcnow()
-        output = subprocess.check_output(['python3', 'mendeley-backup.py', '--config-file', CONFIG_FILE, 
-                                          '--output-dir', OUTPUT_DIR, '--pattern', OUTPUT_PATTERN,
-                                          '--token-file', TOKEN_FILE])
-        self.check_stdout(output.decode('utf-8'), 0, 0, 1, 0)
-        self.check_document(output_path.joinpath('Doe', f'2024 - {DOCUMENT_TITLE_PREFIX} 3'),
-                            f'{DOCUMENT_TITLE_PREFIX} 3', 'working_paper', [('John', 'Doe')], 2024, 
-                            {})
-        self.assertFalse(output_path.joinpath('Doe', f'2024 - {DOCUMENT_TITLE_PREFIX} 3', 'document32.pdf').exists(),
+        self.run_backup_and_check((0, 0, 1, 0), None,
+                                  [(self.DIR_3, self.TITLE_3, 'working_paper', [('John', 'Doe')], 2024, 
+                                    set())])
+        self.assertFalse(self.DIR_3.joinpath('document32.pdf').exists(),
                          'The file document32.pdf was not removed')
 
 if __name__ == '__main__':